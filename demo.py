@@ -1,13 +1,103 @@
-import time
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
 import os
 import re
-import subprocess
-from typing import Optional
+import signal
+import string
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, Dict, List, Optional
 
-from openai import OpenAI
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# One pooled HTTP/2 client for every call, so concurrent requests share warm
+# connections instead of paying a TLS handshake each.
+client = AsyncOpenAI(
+    api_key=api_key,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
+
+MODEL = "gpt-4o-2024-08-06"
+# Deterministic sampling, so a cached response is as good as a fresh one.
+TEMPERATURE = 0
+# Retries after an unparseable answer sample more freely, since resending the same
+# prompt at temperature 0 mostly returns the same answer. Sampled answers are not
+# cached, since the cache key is for the deterministic TEMPERATURE request.
+RETRY_TEMPERATURE = 0.7
+# Safety net on the length of a single-question answer; streaming normally stops
+# well before this, right after the code block closes.
+MAX_TOKENS = 4096
+# Responses that yielded valid code, keyed by a hash of the request.
+CODEGEN_CACHE_DIR = "./.cache/codegen"
+# Learned question shapes (regex + code template), keyed by a hash of the regex.
+SHAPE_CACHE_DIR = "./.cache/shapes"
+# Seconds between status checks while waiting on a submitted batch.
+BATCH_POLL_INTERVAL = 30
+
+# Upper bound on questions in flight at once, so a long question list does not
+# burst past the OpenAI rate limits.
+MAX_CONCURRENCY = 20
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def _warmup():
+    # Pay the numpy/plotly import cost once per worker instead of once per script;
+    # the generated code's own imports then hit sys.modules.
+    try:
+        import numpy  # noqa: F401
+        import plotly.graph_objects  # noqa: F401
+    except ImportError:
+        # Leave the error to surface from the generated code itself
+        pass
+
+
+# Generated code runs in these long-lived workers rather than a fresh interpreter
+# per question. Start demo.py from the target env (e.g. `conda run -n lm-eval`)
+# so the workers have numpy and plotly available.
+EXEC_WORKERS = os.cpu_count() or 1
+# Seconds a generated script may run before it is interrupted.
+EXEC_TIMEOUT = 10
+# Extra seconds the event loop waits on a worker before giving up on it.
+EXEC_TIMEOUT_GRACE = 5
+_executor = ProcessPoolExecutor(max_workers=EXEC_WORKERS, initializer=_warmup)
+# At most one script per worker is submitted at a time, so a script starts running
+# as soon as it is submitted and the loop-side deadline measures its run time rather
+# than time spent queued behind other scripts.
+_exec_semaphore = asyncio.Semaphore(EXEC_WORKERS)
+# Generated scripts and their html output live here; resolved and created once,
+# so per-question paths under it are already absolute.
+TEMP_FOLDER = os.path.abspath("./temp")
+os.makedirs(TEMP_FOLDER, exist_ok=True)
+
+# Regex to find the python code block, case-insensitive match for 'python'
+_CODE_RE = re.compile(r"import numpy as np\s*(.*?)\s*```", re.IGNORECASE | re.DOTALL)
+# Splits a packed answer on its "### Q<n>" headings
+_QUESTION_HEADING_RE = re.compile(r"^\s*###\s*Q(\d+)\b", re.MULTILINE)
+# The regex and code template a shape-learning answer adds after its code block
+_REGEX_BLOCK_RE = re.compile(r"```regex[ \t]*\n(.*?)```", re.IGNORECASE | re.DOTALL)
+_TEMPLATE_BLOCK_RE = re.compile(r"```template[ \t]*\n(.*?)```", re.IGNORECASE | re.DOTALL)
+
+# Question regex -> str.format template of the script, for questions that only
+# differ from an earlier one in their numbers. Filled from SHAPE_CACHE_DIR.
+_shape_cache: Dict[re.Pattern, str] = {}
+# Model-written regexes can backtrack catastrophically, which no signal interrupts,
+# so they only run in this separate worker, one check at a time, under a timeout.
+SHAPE_MATCH_TIMEOUT = 2
+_shape_executor = ProcessPoolExecutor(max_workers=1)
+_shape_lock = asyncio.Lock()
 
 
 def extract_python_code(text: str) -> Optional[str]:
@@ -21,9 +111,7 @@ def extract_python_code(text: str) -> Optional[str]:
     Returns:
         Optional[str]: Extracted Python code block, or None if no code block is found.
     """
-    # Regex to find the python code block, case-insensitive match for 'python'
-    pattern = r"import numpy as np\s*(.*?)\s*```"
-    match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+    match = _CODE_RE.search(text)
     
     if match:
         # Extract code block
@@ -31,84 +119,594 @@ def extract_python_code(text: str) -> Optional[str]:
     
     return None
 
-def get_prompt(question):
-    system_prompt = "You are an AI tutor specializing in computer graphics. Given the following question, generate a Python script using Plotly that visualizes the scenario described and save it as html. The code should be self-contained and executable, including all necessary imports and definitions."
-    template = """
-##Question:
-{question}
+def extract_python_codes(text: str, count: int) -> List[Optional[str]]:
+    """
+    Extract one Python code block per question from a packed answer, where each answer
+    starts with its "### Q<n>" heading.
+    
+    Args:
+        text (str): The text containing the headed code blocks.
+        count (int): The number of questions that were asked.
+        
+    Returns:
+        List[Optional[str]]: Extracted code per question index, or None where the answer
+        is missing or has no code block.
+    """
+    codes = [None] * count
+    # re.split with a capture group yields [preamble, n1, body1, n2, body2, ...]
+    parts = _QUESTION_HEADING_RE.split(text)
+    for number, body in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < count and codes[index] is None:
+            codes[index] = extract_python_code(body)
+    return codes
 
-##Output:
+def _codegen_cache_path(prompt) -> str:
+    request = json.dumps({"model": MODEL, "temperature": TEMPERATURE, "messages": prompt}, sort_keys=True)
+    digest = hashlib.sha256(request.encode('utf-8')).hexdigest()
+    return os.path.join(CODEGEN_CACHE_DIR, f"{digest}.json")
 
-Fill below Python code in a standalone code block.
+
+def load_cached_response(prompt) -> Optional[str]:
+    """
+    Look up a previous model response for exactly this prompt.
+    
+    Args:
+        prompt (List[dict]): The chat messages of the request.
+        
+    Returns:
+        Optional[str]: The cached response text, or None on a cache miss.
+    """
+    try:
+        with open(_codegen_cache_path(prompt)) as f:
+            return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def store_cached_response(prompt, response: str):
+    """
+    Persist a model response so later runs with the same prompt skip the API call.
+    
+    Args:
+        prompt (List[dict]): The chat messages of the request.
+        response (str): The response text to cache.
+    """
+    os.makedirs(CODEGEN_CACHE_DIR, exist_ok=True)
+    with open(_codegen_cache_path(prompt), 'w') as f:
+        json.dump({"response": response}, f)
+
+def _render_template(pattern: re.Pattern, template: str, question: str) -> Optional[str]:
+    match = pattern.fullmatch(question.strip())
+    if match is None:
+        return None
+    try:
+        python_code = template.format(**match.groupdict())
+        compile(python_code, '<shape>', 'exec')
+    except Exception:
+        # The template is model-written, so str.format can fail in any number of ways
+        # (e.g. {a.real} or {a[x]} on a captured string)
+        return None
+    return python_code
+
+
+def _template_fields(template: str) -> Optional[set]:
+    # Names of the fields a str.format template uses, e.g. {"x"} for "{x.real}"
+    try:
+        return {
+            re.split(r"[.\[]", field, maxsplit=1)[0]
+            for _, field, _, _ in string.Formatter().parse(template)
+            if field is not None
+        }
+    except ValueError:
+        return None
+
+
+def _normalize_code(python_code: str) -> str:
+    return "\n".join(line.rstrip() for line in python_code.strip().splitlines() if line.strip())
+
+
+def _match_shape(pattern: str, template: str, question: str) -> Optional[str]:
+    # Runs in _shape_executor
+    return _render_template(re.compile(pattern, re.DOTALL), template, question)
+
+
+def _shape_path(pattern: re.Pattern) -> str:
+    digest = hashlib.sha256(pattern.pattern.encode('utf-8')).hexdigest()
+    return os.path.join(SHAPE_CACHE_DIR, f"{digest}.json")
+
+
+def forget_shape(pattern: re.Pattern):
+    """
+    Drop a learned shape from memory and from SHAPE_CACHE_DIR.
+    
+    Args:
+        pattern (re.Pattern): The shape's question regex.
+    """
+    _shape_cache.pop(pattern, None)
+    try:
+        os.remove(_shape_path(pattern))
+    except OSError:
+        pass
+
+
+async def _check_shape(pattern: re.Pattern, template: str, question: str) -> Optional[str]:
+    global _shape_executor
+    async with _shape_lock:
+        executor = _shape_executor
+        future = executor.submit(_match_shape, pattern.pattern, template, question)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=SHAPE_MATCH_TIMEOUT)
+        except (TimeoutError, asyncio.TimeoutError, BrokenProcessPool):
+            # Stuck backtracking (or crashed): replace the worker, and forget the shape
+            # so neither this run nor later ones try it again
+            _terminate_pool(executor)
+            _shape_executor = ProcessPoolExecutor(max_workers=1)
+            forget_shape(pattern)
+            print(f'Dropped learned shape {pattern.pattern!r}: matching it did not finish')
+            return None
+
+
+async def render_from_shape(question: str) -> Optional[str]:
+    """
+    Build the script for a question locally when it has the shape of one answered before,
+    by filling that answer's template with the values matched from this question.
+    
+    Args:
+        question (str): The question to generate code for.
+        
+    Returns:
+        Optional[str]: The rendered Python code, or None if no learned shape fits.
+    """
+    for pattern, template in list(_shape_cache.items()):
+        python_code = await _check_shape(pattern, template, question)
+        if python_code is not None:
+            return python_code
+    return None
+
+
+async def learn_shape(question: str, response: str):
+    """
+    Register the regex and code template from a shape-learning answer, provided the
+    regex has named groups that the template all uses, and filling the template from
+    the question it was written for reproduces the answer's own code.
+    
+    Args:
+        question (str): The question the answer is for.
+        response (str): The model's answer, generated with get_prompt(..., learn_shape=True).
+    """
+    regex_match = _REGEX_BLOCK_RE.search(response)
+    template_match = _TEMPLATE_BLOCK_RE.search(response)
+    if regex_match is None or template_match is None:
+        return
+    try:
+        pattern = re.compile(regex_match.group(1).strip(), re.DOTALL)
+    except re.error:
+        return
+    template = template_match.group(1).strip()
+    python_code = extract_python_code(response)
+    fields = _template_fields(template)
+    # A regex whose captures the template ignores (or that captures nothing) cannot
+    # tell one question of the shape from another, and would answer unrelated
+    # questions with this script
+    if python_code is None or fields is None or not pattern.groupindex or not set(pattern.groupindex) <= fields:
+        return
+    if pattern in _shape_cache:
+        return
+    # The template must be the answer's script with the question's values lifted out
+    rendered = await _check_shape(pattern, template, question)
+    if rendered is None or _normalize_code(rendered) != _normalize_code(python_code):
+        return
+    
+    _shape_cache[pattern] = template
+    os.makedirs(SHAPE_CACHE_DIR, exist_ok=True)
+    with open(_shape_path(pattern), 'w') as f:
+        json.dump({"pattern": pattern.pattern, "template": template}, f)
+
+
+def load_shapes():
+    """
+    Load the shapes learned in earlier runs from SHAPE_CACHE_DIR.
+    """
+    if not os.path.isdir(SHAPE_CACHE_DIR):
+        return
+    for name in os.listdir(SHAPE_CACHE_DIR):
+        try:
+            with open(os.path.join(SHAPE_CACHE_DIR, name)) as f:
+                shape = json.load(f)
+            pattern = re.compile(shape["pattern"], re.DOTALL)
+            fields = _template_fields(shape["template"])
+            # Shapes saved before the template had to use every capture are dropped too
+            if pattern.groupindex and fields is not None and set(pattern.groupindex) <= fields:
+                _shape_cache[pattern] = shape["template"]
+        except (OSError, ValueError, KeyError, re.error):
+            continue
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError()
+
+
+def _run_generated_code(python_code: str, filename: str, cwd: str, timeout: int = EXEC_TIMEOUT) -> str:
+    """
+    Execute generated code inside a pool worker, in a fresh module namespace.
+    
+    Args:
+        python_code (str): The code to execute.
+        filename (str): The file the code was saved to, used in tracebacks.
+        cwd (str): Working directory the code runs in, where its html output lands.
+        timeout (int): Seconds before the code is interrupted with a TimeoutError.
+        
+    Returns:
+        str: Everything the code printed to stdout and stderr.
+    """
+    os.chdir(cwd)
+    output = io.StringIO()
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            exec(compile(python_code, filename, 'exec'), {"__name__": "__main__"})
+    except SystemExit as e:
+        # Behave like the script's own process exiting: status 0/None is success
+        if e.code not in (None, 0):
+            raise RuntimeError(f'generated code exited with status {e.code}') from None
+    except Exception:
+        raise
+    except BaseException as e:
+        # Anything else (e.g. KeyboardInterrupt) would otherwise escape the future and
+        # end the event loop for every question
+        raise RuntimeError(f'generated code raised {type(e).__name__}') from None
+    finally:
+        signal.alarm(0)
+    return output.getvalue()
+
+
+def _recycle_executor(stale: ProcessPoolExecutor, terminate: bool = False):
+    """
+    Replace a pool that can no longer run code, e.g. because generated code called
+    os._exit() or crashed its worker, unless another question already replaced it.
+    
+    Args:
+        stale (ProcessPoolExecutor): The pool the failed question ran on.
+        terminate (bool): Also kill the stale pool's workers, for a worker stuck past
+            its timeout that would otherwise hold its slot and block interpreter exit.
+    """
+    global _executor
+    if _executor is stale:
+        _executor = ProcessPoolExecutor(max_workers=EXEC_WORKERS, initializer=_warmup)
+    if terminate:
+        _terminate_pool(stale)
+    else:
+        stale.shutdown(wait=False, cancel_futures=True)
+
+
+def _terminate_pool(executor: ProcessPoolExecutor):
+    # ProcessPoolExecutor has no public way to stop a busy worker, and cannot tell
+    # which worker runs which task, so the whole pool goes
+    for process in list((executor._processes or {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def warm_pool():
+    """
+    Start every pool worker now, so their warmup imports overlap with the first API calls.
+    """
+    for _ in range(EXEC_WORKERS):
+        _executor.submit(int)
+
+# The fixed parts of the prompts are built once here, and get_prompt only appends
+# the question(s) at the very end, so every request has the same layout.
+SYSTEM_PROMPT = "You are an AI tutor specializing in computer graphics. Given the following question, generate a Python script using Plotly that visualizes the scenario described and save it as html. The code should be self-contained and executable, including all necessary imports and definitions."
+PACKED_SYSTEM_PROMPT = "You are an AI tutor specializing in computer graphics. Given the following questions, generate for each one a Python script using Plotly that visualizes the scenario described and save it as html. Each script should be self-contained and executable, including all necessary imports and definitions."
+CODE_SKELETON = """Build grids with np.mgrid as float arrays (e.g. `xx, yy = np.mgrid[-5:6, -5:6].astype(np.float32)`) and evaluate surfaces in place into a preallocated array (`zz = np.empty_like(xx)`, then `np.multiply(..., out=zz)`, `zz += ...`).
 ```python
 import numpy as np
 import plotly.graph_objects as go
-import time
+import os
+import uuid
 
-fig.write_html(f'temp_{{time.time()}}.html')
+fig.write_html(f'temp_{os.getpid()}_{uuid.uuid4().hex}.html')
 ```
+"""
+TEMPLATE_HEAD = """
+##Output:
+
+Fill below Python code in a standalone code block.
+""" + CODE_SKELETON + """
+##Question:
+"""
+SHAPE_INSTRUCTIONS = """
+After that code block, generalize your script to every question of the same shape as this one:
+1. In a ```regex block, give a Python regular expression that matches the whole question, with one named group for each value that could change (coordinates, coefficients, ...).
+2. In a ```template block, repeat the script as a Python str.format template that uses {group_name} wherever a captured value is needed, with every literal brace doubled.
+"""
+SHAPE_TEMPLATE_HEAD = """
+##Output:
 
+Fill below Python code in a standalone code block.
+""" + CODE_SKELETON + SHAPE_INSTRUCTIONS + """
+##Question:
 """
+PACKED_TEMPLATE_HEAD = """
+##Output:
+
+Answer every question separately and in order. Start each answer with its heading (e.g. ### Q1) on its own line, then fill below Python code in a standalone code block.
+""" + CODE_SKELETON + """
+##Questions:
+"""
+TEMPLATE_TAIL = "\n"
+
+
+def get_prompt(question, learn_shape=False):
+    template_head = SHAPE_TEMPLATE_HEAD if learn_shape else TEMPLATE_HEAD
     message = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": template.format(question=question)}
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": template_head + question + TEMPLATE_TAIL}
     ]
     return message
 
 
-def get_code(prompt, max_retry=3):
-    completion = client.chat.completions.create(
-        model="gpt-4o-2024-08-06",
-        messages=prompt,
-    )
+def get_packed_prompt(questions):
+    packed = "\n".join(f"### Q{index}\n{question}" for index, question in enumerate(questions, start=1))
+    message = [
+        {"role": "system", "content": PACKED_SYSTEM_PROMPT},
+        {"role": "user", "content": PACKED_TEMPLATE_HEAD + packed + TEMPLATE_TAIL}
+    ]
+    return message
+
+
+# Transient API failures: rate limits, dropped connections, timeouts and 5xx.
+# Retried with jittered exponential backoff in place of the SDK's own retries.
+@retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )),
+    reraise=True,
+)
+async def create_completion(messages, until: Optional[re.Pattern] = None, max_tokens: Optional[int] = None,
+                            temperature: float = TEMPERATURE) -> str:
+    """
+    Stream a chat completion and return its text, stopping early once the part we need
+    has arrived instead of waiting for the model to finish.
     
-    return_message = completion.choices[0].message.content
-    python_code = extract_python_code(return_message)
-    if python_code is None and max_retry > 0:
-        get_code(prompt, max_retry - 1)
-    return python_code
+    Args:
+        messages (List[dict]): The chat messages of the request.
+        until (Optional[re.Pattern]): Stop reading as soon as the text so far matches this
+            pattern. None reads the whole response.
+        max_tokens (Optional[int]): Upper bound on generated tokens.
+        temperature (float): Sampling temperature.
+        
+    Returns:
+        str: The response text received so far.
+    """
+    stream = await client.with_options(max_retries=0).chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=openai.NOT_GIVEN if max_tokens is None else max_tokens,
+        stream=True,
+    )
+    text = ""
+    try:
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            delta = chunk.choices[0].delta.content
+            text += delta
+            # Every block we wait for ends with a fence, so only rescan when one may have closed
+            if until is not None and '`' in delta and until.search(text):
+                break
+    finally:
+        await stream.close()
+    return text
+
+
+async def _notify_response(on_response: Optional[Callable[[str], Awaitable[None]]], response: str):
+    # The hook only adds optional extras (e.g. shape learning); it must never cost the
+    # question its code, nor keep failing on a response that is already cached.
+    if on_response is None:
+        return
+    try:
+        await on_response(response)
+    except Exception as e:
+        print(f'Ignoring failed response hook: {str(e)}')
 
 
-def process_question(question):
-    prompt = get_prompt(question)
-    python_code = get_code(prompt)
+async def get_code(prompt, max_retry=3, on_response: Optional[Callable[[str], Awaitable[None]]] = None, until=_CODE_RE):
+    cached_message = load_cached_response(prompt)
+    if cached_message is not None:
+        await _notify_response(on_response, cached_message)
+        return extract_python_code(cached_message)
     
+    # One initial attempt plus up to max_retry retries when no code block is found
+    for attempt in range(max_retry + 1):
+        temperature = TEMPERATURE if attempt == 0 else RETRY_TEMPERATURE
+        return_message = await create_completion(prompt, until=until, max_tokens=MAX_TOKENS, temperature=temperature)
+        python_code = extract_python_code(return_message)
+        if python_code is not None:
+            if temperature == TEMPERATURE:
+                store_cached_response(prompt, return_message)
+            await _notify_response(on_response, return_message)
+            return python_code
+    return None
+
+
+async def process_question(question, learn_shapes=False):
+    # Learned shapes only answer questions when the user opted in to them
+    python_code = await render_from_shape(question) if learn_shapes else None
+    if python_code is None:
+        prompt = get_prompt(question, learn_shape=learn_shapes)
+        on_response = (lambda response: learn_shape(question, response)) if learn_shapes else None
+        # A shape-learning answer is only complete once its template block has closed
+        until = _TEMPLATE_BLOCK_RE if learn_shapes else _CODE_RE
+        try:
+            async with _semaphore:
+                python_code = await get_code(prompt, on_response=on_response, until=until)
+        except openai.OpenAIError as e:
+            # Keep one question's API failure from cancelling the others in gather
+            print(f'Exception for question {question} {str(e)}')
+            return
+    await run_code(question, python_code)
+
+
+async def run_code(question, python_code):
     if python_code is None:
         print(f'For question {question}- cannot find valid test code, passed by it.')
         return
     
-    
-    temp_folder = "./temp"
-    
-    test_path = os.path.join(temp_folder, "test.py")
-
-    with open(test_path, 'w') as f:
+    # A file per question, so concurrent questions never overwrite each other's code
+    with tempfile.NamedTemporaryFile('w', suffix='.py', dir=TEMP_FOLDER, delete=False) as f:
         f.write(python_code)
+        full_test_path = f.name
         
     try:
-        # Use os.path.abspath to get the full path of test.py
-        full_test_path = os.path.abspath(os.path.join(temp_folder, 'test.py'))
-
-        # Run the test with timeout and capture output
-        output = subprocess.check_output(
-            [
-                "bash", "-c",
-                # Using conda run with absolute path to the script
-                f"conda run -n lm-eval python {full_test_path}"
-            ],
-            cwd=temp_folder,  # Ensure correct working directory
-            timeout=10,  # Timeout in seconds
-            stderr=subprocess.STDOUT
-        ).decode('utf-8')
-
-    except subprocess.TimeoutExpired:
+        # Run the code in a pool worker without blocking the event loop. The worker
+        # enforces EXEC_TIMEOUT itself; if it ignores SIGALRM (e.g. stuck in C code),
+        # the grace period expiring kills its pool and continues on a fresh one.
+        async with _exec_semaphore:
+            executor = _executor
+            future = executor.submit(_run_generated_code, python_code, full_test_path, TEMP_FOLDER)
+            output = await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout=EXEC_TIMEOUT + EXEC_TIMEOUT_GRACE
+            )
+
+    except (TimeoutError, asyncio.TimeoutError):
+        # wait_for tries to cancel the future when the grace period runs out. That
+        # succeeds for a script that never started, and a TimeoutError from the
+        # worker's own alarm leaves the future done; only a script still running is
+        # stuck and needs its pool killed.
+        if future.running():
+            _recycle_executor(executor, terminate=True)
         print(f'Timeout occurred for question {question}')
+    except BrokenProcessPool as e:
+        _recycle_executor(executor)
+        print(f'Exception for question {question} {str(e)}')
     except Exception as e:
         print(f'Exception for question {question} {str(e)}')
+    finally:
+        os.unlink(full_test_path)
 
 
+async def submit_batch(questions) -> List[Optional[str]]:
+    """
+    Generate code for all questions through the OpenAI Batch API, which is billed at half
+    price and has its own rate limits, at the cost of completing within 24h instead of
+    interactively.
+    
+    Args:
+        questions (List[str]): The questions to generate code for.
+        
+    Returns:
+        List[Optional[str]]: Extracted Python code per question, in input order, or None
+        where the request failed or no code block was found.
+    """
+    prompts = [get_prompt(question) for question in questions]
+    codes = [None] * len(questions)
+    lines = []
+    for index, prompt in enumerate(prompts):
+        cached_message = load_cached_response(prompt)
+        if cached_message is not None:
+            codes[index] = extract_python_code(cached_message)
+            continue
+        lines.append(json.dumps({
+            "custom_id": f"q{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": MODEL, "temperature": TEMPERATURE, "messages": prompt},
+        }))
+    if not lines:
+        return codes
+    
+    batch_file = await client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await client.batches.retrieve(batch.id)
+    
+    if batch.status != "completed" or batch.output_file_id is None:
+        print(f'Batch {batch.id} ended with status {batch.status}')
+        return codes
+    
+    output = await client.files.content(batch.output_file_id)
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        response = result.get("response")
+        if result.get("error") or not response or response["status_code"] != 200:
+            continue
+        index = int(result["custom_id"][1:])
+        return_message = response["body"]["choices"][0]["message"]["content"]
+        if not return_message:
+            # e.g. a refusal, which comes back with content None
+            continue
+        codes[index] = extract_python_code(return_message)
+        if codes[index] is not None:
+            store_cached_response(prompts[index], return_message)
+    return codes
+
+
+async def get_codes_packed(questions) -> List[Optional[str]]:
+    """
+    Generate code for all questions with a single chat request, so a request-per-minute
+    limit does not serialize generation. Questions whose answer cannot be parsed are
+    retried individually.
+    
+    Args:
+        questions (List[str]): The questions to generate code for.
+        
+    Returns:
+        List[Optional[str]]: Extracted Python code per question, in input order.
+    """
+    async with _semaphore:
+        return_message = await create_completion(get_packed_prompt(questions))
+    codes = extract_python_codes(return_message, len(questions))
+    
+    async def fallback(index):
+        try:
+            async with _semaphore:
+                codes[index] = await get_code(get_prompt(questions[index]))
+        except openai.OpenAIError as e:
+            print(f'Exception for question {questions[index]} {str(e)}')
+    
+    await asyncio.gather(*(fallback(index) for index, code in enumerate(codes) if code is None))
+    return codes
+
+
+async def main(questions, batch=False, packed=False, learn_shapes=False):
+    warm_pool()
+    if learn_shapes:
+        load_shapes()
+    if batch or packed:
+        codes = await (submit_batch(questions) if batch else get_codes_packed(questions))
+        await asyncio.gather(*(run_code(question, code) for question, code in zip(questions, codes)))
+    else:
+        await asyncio.gather(*(process_question(question, learn_shapes) for question in questions))
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--batch", action="store_true",
+                      help="Generate code through the OpenAI Batch API (cheaper, but may take up to 24h).")
+    mode.add_argument("--packed", action="store_true",
+                      help="Ask all questions in a single chat request.")
+    parser.add_argument("--learn-shapes", action="store_true",
+                        help="Answer questions matching a previously learned shape without an API call, and "
+                             "ask for a regex and code template per new question to learn more (default mode only).")
+    args = parser.parse_args()
+    
     questions = [
         """Given is a light source at the position
 L=(1,3,0)T
@@ -127,5 +725,4 @@ $p(t)=\left(\begin{array}{l}1 \\ 0 \\ 1\end{array}\right)+t *\left(\begin{array}
 For what value of c is the ray parallel to the plane?
 """
     ]
-    for question in questions:
-        process_question(question)
+    asyncio.run(main(questions, batch=args.batch, packed=args.packed, learn_shapes=args.learn_shapes))
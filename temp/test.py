@@ -6,16 +6,19 @@ import time
 # Normal to the plane: [3, 2, -1]
 # Ray with c = 3/2: p(t) = [1, 0, 1] + t * [-1, 3/2, 0]
 
-# Create a meshgrid for the plane
-xx, yy = np.meshgrid(range(-5, 6), range(-5, 6))
-zz = 3 * xx + 2 * yy - 3
+# Create a float grid for the plane and evaluate z = 3x + 2y - 3 in place
+xx, yy = np.mgrid[-5:6, -5:6].astype(np.float32)
+zz = np.empty_like(xx)
+np.multiply(xx, 3, out=zz)
+zz += 2 * yy
+zz -= 3
 
 # Parameters for the ray
 c = 3/2
 t_values = np.linspace(-5, 5, 200)
-ray_x = 1 + t_values * -1
-ray_y = 0 + t_values * c
-ray_z = 1 + t_values * 0
+ray_x = 1 - t_values
+ray_y = c * t_values
+ray_z = np.ones_like(t_values)
 
 # Create the Plotly figure
 fig = go.Figure()